@@ -15,11 +15,30 @@
 ################################################################################
 
 import json
+import os
 import logging
 import logging.handlers
 import sys
 import datetime
 import platform
+import time
+import copy
+import random
+import hashlib
+import ipaddress
+import threading
+import queue
+import atexit
+import csv
+import contextlib
+import resource
+import urllib.parse
+import cProfile
+import pstats
+import tracemalloc
+import itertools
+import bisect
+from concurrent import futures
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -59,36 +78,551 @@ class BqnRestAdapter(HTTPAdapter):
 
 ################################################################################
 
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+  """
+  Passes log records to a QueueListener thread that writes them, so logging
+  does not wait for the log file. If the queue is full, records below
+  WARNING are dropped instead of waiting, and the number dropped is logged
+  when there is room again.
+  """
+
+  def __init__(self, queue):
+    super().__init__(queue)
+    self.dropped = 0
+
+  def enqueue(self, record):
+    if self.dropped:
+      try:
+        self.queue.put_nowait(logging.makeLogRecord({"msg": "%s %d log records dropped (log queue full)" % \
+                                                     (datetime.datetime.now(), self.dropped),
+                                                     "levelno": logging.WARNING, "levelname": "WARNING"}))
+        self.dropped = 0
+      except queue.Full:
+        pass
+    if record.levelno >= logging.WARNING:
+      self.queue.put(record)
+    else:
+      try:
+        self.queue.put_nowait(record)
+      except queue.Full:
+        self.dropped += 1
+
+################################################################################
+
+class BqnWriteExecutor:
+  """
+  Runs BQN write requests concurrently in a bounded thread pool.
+  The number of requests in flight adapts to BQN: it grows by one after a
+  window of fast successful requests and it is halved when a request is slow
+  or fails, so a BQN busy shaping traffic is not overloaded.
+  Requests must return the HTTP response, or None if there was an error.
+  Neither responses nor futures are kept, and submit blocks when too many
+  requests are queued, so memory does not grow with the number of requests.
+  """
+  # Requests queued or in flight per worker before submit blocks
+  QUEUE_PER_WORKER = 4
+
+  def __init__(self, logger, maxWorkers, targetLatency):
+    self.logger = logger
+    self.maxWorkers = maxWorkers
+    self.targetLatency = targetLatency
+    self.limit = max(1, maxWorkers // 2)
+    self.active = 0
+    self.successes = 0
+    self.outstanding = 0
+    self.cond = threading.Condition()
+    self.pool = futures.ThreadPoolExecutor(max_workers=maxWorkers)
+
+  def submit(self, fn, *args):
+    with self.cond:
+      while self.outstanding >= self.maxWorkers * BqnWriteExecutor.QUEUE_PER_WORKER:
+        self.cond.wait()
+      self.outstanding += 1
+    self.pool.submit(self.run, fn, *args)
+
+  def run(self, fn, *args):
+    with self.cond:
+      while self.active >= self.limit:
+        self.cond.wait()
+      self.active += 1
+    start = time.monotonic()
+    success = False
+    try:
+      rsp = fn(*args)
+      success = rsp is not None and rsp.status_code < 500 and rsp.status_code != 429
+    finally:
+      self.adapt(time.monotonic() - start, success)
+
+  def adapt(self, latency, success):
+    with self.cond:
+      self.active -= 1
+      self.outstanding -= 1
+      if not success or latency > self.targetLatency:
+        if self.limit > 1:
+          self.limit = max(1, self.limit // 2)
+          self.logger.debug("BQN %s (%.2f s), concurrency down to %d" % \
+                            ("error" if not success else "slow", latency, self.limit))
+        self.successes = 0
+      else:
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.maxWorkers:
+          self.limit += 1
+          self.successes = 0
+      self.cond.notify_all()
+
+  def wait(self):
+    """
+    Waits until all submitted requests are completed. Used as a barrier between
+    operations that must be ordered (e.g. policies before subscribers).
+    """
+    with self.cond:
+      while self.outstanding > 0:
+        self.cond.wait()
+
+  def shutdown(self):
+    self.wait()
+    self.pool.shutdown()
+
+################################################################################
+
+class SyncProfiler:
+  """
+  CPU profile and memory allocations of synchronization phases, written to a
+  directory per phase: <phase>.pstats (cProfile dump, to be sorted with
+  python3 -m pstats), <phase>.txt (functions with most cumulative time) and
+  <phase>.memory.txt (peak traced memory and lines that allocated most).
+  A phase started inside another in the same thread is part of the outer
+  one. Only one phase is CPU profiled at a time (python 3.12 allows a single
+  profiler per process), so a phase starting while another is profiled only
+  gets its memory report. Memory is traced for the whole process, so phases
+  running at the same time share allocations.
+  Files of a phase are overwritten each time the phase runs.
+  """
+  # Functions and allocation lines in the text reports
+  TOP_ENTRIES = 30
+
+  def __init__(self, profileDir):
+    self.profileDir = profileDir
+    self.local = threading.local()
+    self.cpuLock = threading.Lock()  # Held by the phase being CPU profiled
+    os.makedirs(profileDir, exist_ok=True)
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def getPath(self, phase, suffix):
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in phase)
+    return os.path.join(self.profileDir, name + suffix)
+
+  @contextlib.contextmanager
+  def phase(self, phase):
+    if getattr(self.local, "active", False):  # Inside another phase of this thread
+      yield
+      return
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    profile = None
+    if self.cpuLock.acquire(blocking=False):
+      profile = cProfile.Profile()
+      try:
+        profile.enable()
+      except ValueError:  # Another profiling tool active
+        self.cpuLock.release()
+        profile = None
+    self.local.active = True
+    try:
+      yield
+    finally:
+      self.local.active = False
+      if profile:
+        profile.disable()
+        self.cpuLock.release()
+      self.write(phase, profile, before)
+
+  def write(self, phase, profile, before):
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    if profile:
+      profile.dump_stats(self.getPath(phase, ".pstats"))
+      with open(self.getPath(phase, ".txt"), "w", encoding="utf-8") as f:
+        pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(SyncProfiler.TOP_ENTRIES)
+    else:
+      # Not to be taken for a profile of this run
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(self.getPath(phase, ".pstats"))
+      with open(self.getPath(phase, ".txt"), "w", encoding="utf-8") as f:
+        f.write("Phase %s not CPU profiled: another phase or profiling tool was active at the same time\n" % phase)
+    with open(self.getPath(phase, ".memory.txt"), "w", encoding="utf-8") as f:
+      f.write("Phase %s\n" % phase)
+      f.write("Peak traced memory: %.1f MB (%.1f MB at end)\n" % (peak/2**20, current/2**20))
+      f.write("Top %d lines by memory allocated in the phase and not released:\n" % SyncProfiler.TOP_ENTRIES)
+      # Allocations of the snapshots themselves left out
+      filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+      stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+      for stat in stats[:SyncProfiler.TOP_ENTRIES]:
+        f.write("%s\n" % stat)
+
+################################################################################
+
+class SyncMetrics:
+  """
+  Performance metrics of a synchronization: wall time of each phase, count and
+  latency histogram of HTTP requests per method and endpoint, payload sizes
+  and peak memory. Written as JSON or as a node-exporter textfile.
+  """
+  # Upper bounds of the request latency histogram buckets, in seconds
+  LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+  def __init__(self, profiler=None):
+    self.lock = threading.Lock()
+    self.profiler = profiler  # SyncProfiler of phases, if any
+    self.startTime = time.time()
+    self.phases = {}
+    self.phaseStarts = {}
+    self.requests = {}
+    self.payloads = {}
+
+  def start(self, phase):
+    self.phaseStarts[phase] = time.monotonic()
+
+  def stop(self, phase):
+    elapsed = time.monotonic() - self.phaseStarts.pop(phase)
+    with self.lock:
+      self.phases[phase] = self.phases.get(phase, 0) + elapsed
+
+  @contextlib.contextmanager
+  def phase(self, phase):
+    self.start(phase)
+    try:
+      with self.profiler.phase(phase) if self.profiler else contextlib.nullcontext():
+        yield
+    finally:
+      self.stop(phase)
+
+  def observeRequest(self, method, endpoint, status, latency):
+    with self.lock:
+      key = (method, endpoint)
+      if key not in self.requests:
+        self.requests[key] = {"count": 0, "sum": 0.0, "errors": 0,
+                              "buckets": [0] * len(SyncMetrics.LATENCY_BUCKETS)}
+      r = self.requests[key]
+      r["count"] += 1
+      r["sum"] += latency
+      if status >= 400:
+        r["errors"] += 1
+      for i, bound in enumerate(SyncMetrics.LATENCY_BUCKETS):
+        if latency <= bound:
+          r["buckets"][i] += 1
+
+  def addPayload(self, endpoint, direction, size):
+    with self.lock:
+      key = (endpoint, direction)
+      self.payloads[key] = self.payloads.get(key, 0) + size
+
+  def getPeakMemory(self):
+    # Maximum resident set size in bytes (kilobytes in Linux getrusage)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+  def toDict(self):
+    with self.lock:
+      return {
+        "start": self.startTime,
+        "duration": time.time() - self.startTime,
+        "phases": dict(self.phases),
+        "requests": [dict(r, method=k[0], endpoint=k[1]) for k, r in self.requests.items()],
+        "latencyBuckets": SyncMetrics.LATENCY_BUCKETS,
+        "payloads": [{"endpoint": k[0], "direction": k[1], "bytes": v} for k, v in self.payloads.items()],
+        "peakMemory": self.getPeakMemory()
+      }
+
+  def toTextfile(self, prefix="billing_sync"):
+    metrics = self.toDict()
+    lines = []
+    def add(name, help, type, samples):
+      lines.append("# HELP %s_%s %s" % (prefix, name, help))
+      lines.append("# TYPE %s_%s %s" % (prefix, name, type))
+      for labels, value in samples:
+        labelText = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+        lines.append("%s_%s%s %s" % (prefix, name, "{%s}" % labelText if labelText else "", value))
+
+    add("start_timestamp_seconds", "Start time of the last synchronization", "gauge",
+        [([], "%.3f" % metrics["start"])])
+    add("duration_seconds", "Wall time of the last synchronization", "gauge",
+        [([], "%.3f" % metrics["duration"])])
+    add("phase_duration_seconds", "Wall time of each synchronization phase", "gauge",
+        [([("phase", p)], "%.3f" % t) for p, t in metrics["phases"].items()])
+    # Histogram buckets are already cumulative (each request counted in all buckets above its latency)
+    samples = []
+    for r in metrics["requests"]:
+      labels = [("method", r["method"]), ("endpoint", r["endpoint"])]
+      for bound, count in zip(SyncMetrics.LATENCY_BUCKETS, r["buckets"]):
+        samples.append((labels + [("le", bound)], count))
+      samples.append((labels + [("le", "+Inf")], r["count"]))
+    add("request_duration_seconds", "Latency of HTTP requests in the last synchronization", "histogram", [])
+    for labels, value in samples:
+      lines.append("%s_request_duration_seconds_bucket{%s} %s" % \
+                   (prefix, ','.join('%s="%s"' % (k, v) for k, v in labels), value))
+    for r in metrics["requests"]:
+      labelText = 'method="%s",endpoint="%s"' % (r["method"], r["endpoint"])
+      lines.append("%s_request_duration_seconds_sum{%s} %.6f" % (prefix, labelText, r["sum"]))
+      lines.append("%s_request_duration_seconds_count{%s} %d" % (prefix, labelText, r["count"]))
+    add("request_errors", "HTTP requests with error status in the last synchronization", "gauge",
+        [([("method", r["method"]), ("endpoint", r["endpoint"])], r["errors"]) for r in metrics["requests"]])
+    add("payload_bytes", "Bytes sent or received per endpoint in the last synchronization", "gauge",
+        [([("endpoint", p["endpoint"]), ("direction", p["direction"])], p["bytes"]) for p in metrics["payloads"]])
+    add("peak_memory_bytes", "Peak resident memory of the synchronization process", "gauge",
+        [([], metrics["peakMemory"])])
+    return '\n'.join(lines) + '\n'
+
+  def write(self, jsonFile=None, textFile=None):
+    # Written to a temporary file and renamed, so readers never see a partial file
+    for path, content in [(jsonFile, lambda: json.dumps(self.toDict(), indent=2)),
+                          (textFile, self.toTextfile)]:
+      if not path:
+        continue
+      tmpFile = path + ".tmp"
+      with open(tmpFile, "w", encoding="utf-8") as f:
+        f.write(content())
+      os.replace(tmpFile, path)
+
+################################################################################
+
+class BqnRecord:
+  """
+  Billing entry to send to BQN, with its fields in slots instead of a
+  dictionary to save memory in large networks. Strings are normalized to
+  the BQN form when the entry is built. Fields are accessed as dictionary
+  items, as in BQN JSON entries, and a field set to None is missing.
+  """
+  __slots__ = ()
+  JSON_FIELDS = ()  # Fields sent to BQN
+
+  @staticmethod
+  def normalizeString(value):
+    return value.replace(' ', '_')
+
+  def __getitem__(self, field):
+    try:
+      return getattr(self, field)
+    except AttributeError:
+      raise KeyError(field)
+
+  def __setitem__(self, field, value):
+    try:
+      setattr(self, field, value)
+    except AttributeError:
+      raise KeyError(field)
+
+  def __delitem__(self, field):
+    self[field] = None
+
+  def __contains__(self, field):
+    return self.get(field) is not None
+
+  def get(self, field, default=None):
+    value = getattr(self, field, None)
+    return default if value is None else value
+
+  def keys(self):
+    return [f for f in self.JSON_FIELDS if getattr(self, f) is not None]
+
+  def toJson(self):
+    return {f: getattr(self, f) for f in self.keys()}
+
+  def __repr__(self):
+    return repr(self.toJson())
+
+class Policy(BqnRecord):
+  __slots__ = ("policyName", "policyId", "uplinkRate", "downlinkRate")
+  JSON_FIELDS = ("policyName", "policyId", "rateLimitUplink", "rateLimitDownlink")
+
+  def __init__(self, policyName, policyId, uplinkRate, downlinkRate):
+    self.policyName = self.normalizeString(policyName)
+    self.policyId = self.normalizeString(policyId)
+    self.uplinkRate = uplinkRate
+    self.downlinkRate = downlinkRate
+
+  @property
+  def rateLimitUplink(self):
+    return {"rate": self.uplinkRate}
+
+  @property
+  def rateLimitDownlink(self):
+    return {"rate": self.downlinkRate}
+
+class Subscriber(BqnRecord):
+  # state and block are used to get the policy, they are not sent to BQN
+  __slots__ = ("subscriberIp", "subscriberId", "policyRate", "state", "block")
+  JSON_FIELDS = ("subscriberIp", "subscriberId", "policyRate")
+
+  def __init__(self, subscriberIp, subscriberId, policyRate, state=None, block=False):
+    self.subscriberIp = self.normalizeString(subscriberIp)
+    self.subscriberId = self.normalizeString(subscriberId)
+    self.policyRate = self.normalizeString(policyRate) if policyRate else policyRate
+    self.state = state
+    self.block = block
+
+class SubscriberGroup(BqnRecord):
+  __slots__ = ("subscriberGroupName", "subscriberGroupType", "subscriberMembers", "subscriberRanges", "policyRate")
+  JSON_FIELDS = ("subscriberGroupName", "subscriberGroupType", "subscriberMembers", "subscriberRanges", "policyRate")
+
+  def __init__(self, subscriberGroupName, subscriberGroupType, subscriberMembers=None,
+               subscriberRanges=None, policyRate=None):
+    self.subscriberGroupName = self.normalizeString(subscriberGroupName)
+    self.subscriberGroupType = subscriberGroupType
+    self.subscriberMembers = [self.normalizeString(m) for m in subscriberMembers] if subscriberMembers else []
+    self.subscriberRanges = subscriberRanges
+    self.policyRate = self.normalizeString(policyRate) if policyRate else policyRate
+
+  def addMember(self, address):
+    self.subscriberMembers.append(self.normalizeString(address))
+
+################################################################################
+
+class SyncPlan:
+  """
+  Operations that make the entries of a BQN collection equal to those in
+  billing, built by BillingSync.planBqnUpdate. They can be printed for review
+  or applied.
+  """
+
+  def __init__(self, kind, path):
+    self.kind = kind
+    self.path = path
+    self.operations = []  # (method, key, entry), in the order to send them
+    self.state = {}  # Entries in BQN after the operations, by key
+    self.current = {}  # Entries in BQN before the operations, by key
+    self.deferred = set()  # Keys of creations left to later updates
+
+  def add(self, method, key, entry=None):
+    self.operations.append((method, key, entry))
+
+  def count(self, method):
+    return len([o for o in self.operations if o[0] == method])
+
+################################################################################
+
+class BillingFeed:
+  """
+  Billing data handed to BQN updates one entity at a time, as it is obtained,
+  so BQN updates start before all billing data is ready. Entities are put in
+  update order (see BillingSync.SYNC_KINDS), already adapted with prepareBqnData,
+  or None if unchanged (not to be updated). If billing data cannot be obtained,
+  fail makes the updates waiting for it raise an exception.
+  """
+
+  def __init__(self):
+    self.entries = {}
+    self.error = None
+    self.ready = {kind: threading.Event() for kind in BillingSync.SYNC_KINDS}
+
+  def put(self, kind, entries):
+    self.entries[kind] = entries
+    self.ready[kind].set()
+
+  def fail(self, error):
+    self.error = error
+    for event in self.ready.values():
+      event.set()
+
+  def get(self, kind):
+    self.ready[kind].wait()
+    if not kind in self.entries:
+      raise Exception("No billing %s (%s)" % (kind, self.error))
+    return self.entries[kind]
+
+################################################################################
+
 class BillingSync:
   BLOCK_POLICY = "Billing-Block"
+  # Maximum number of concurrent requests to BQN, also the size of its connection pool
+  BQN_MAX_REQUESTS = 10
+  # BQN latency in seconds above which concurrency is reduced
+  BQN_TARGET_LATENCY = 1.0
+  # Maximum number of log records waiting to be written
+  LOG_QUEUE_SIZE = 10000
+  # Minimum number of contiguous group members sent as a CIDR range (0 to send no ranges)
+  GROUP_RANGE_MIN_ADDRESSES = 2
+  # Fields of each BQN entity kept in the sync state snapshot
+  STATE_FIELDS = {
+    "policies": ["policyName", "policyId", "rateLimitDownlink", "rateLimitUplink"],
+    "subscribers": ["subscriberIp", "subscriberId", "policyRate", "policyAssignedBy"],
+    "subscriberGroups": ["subscriberGroupName", "subscriberMembers", "subscriberRanges", "policyRate"]
+  }
+  # Policy assignment of subscribers created by this script, in the snapshot
+  STATE_ASSIGNED_BY = "billing-sync"
+  # BQN REST collections, whose entry ids are removed from metrics endpoints
+  BQN_COLLECTIONS = ["policies/rate", "subscribers", "subscriberGroups"]
+  # BQN collection of each entity, in update order (policies before the
+  # subscribers using them and subscribers before their groups): REST path,
+  # key field, fields compared with billing and subfields ignored in them
+  SYNC_KINDS = {
+    "policies": {"path": "/policies/rate/", "key": "policyName", "name": "policy", "plural": "policies",
+                 "fields": ["policyId", "rateLimitDownlink", "rateLimitUplink"], "excluded": ["congestionMgmt"]},
+    "subscribers": {"path": "/subscribers/", "key": "subscriberIp", "name": "subscriber", "plural": "subscribers",
+                    "fields": ["subscriberId", "policyRate"], "excluded": []},
+    "subscriberGroups": {"path": "/subscriberGroups/", "key": "subscriberGroupName",
+                         "name": "subscriber group", "plural": "subscriber groups",
+                         "fields": ["subscriberMembers", "subscriberRanges", "policyRate"], "excluded": []}
+  }
+  # Retries of BQN requests with transient errors, and delay before the first
+  # retry in seconds (doubled in each retry)
+  BQN_RETRIES = 3
+  BQN_RETRY_DELAY = 1.0
+  BQN_TRANSIENT_STATUS = [429, 500, 502, 503, 504]
+  # Seconds to connect and to wait for data in HTTP requests, so a server
+  # not answering does not stall a synchronization
+  REQUEST_TIMEOUT = (10, 120)
+  # Classes of subscriber changes, in the order they are sent to BQN: block
+  # or unblock, other policy changes (and creations), subscriber id changes
+  # only and deletions. Each class is sent once the previous one is done.
+  SUBSCRIBER_PRIORITIES = ["block", "policy", "id", "delete"]
 
   ############################################################################
 
   def __init__(self, verbose, logFile=None):
     self.logger = logging.getLogger(__name__)
+    self.bqnWriter = None
+    self.bqnErrors = []
+    self.syncState = None
+    self.newSyncState = {}
+    self.syncShard = None  # Next subscriber shard to update, saved in the snapshot
+    self.bqnPending = 0  # Operations of other shards or past the deadline, left for later updates
+    self.requestTimeout = BillingSync.REQUEST_TIMEOUT  # (connect, read) seconds
+    self.deadline = None  # time.monotonic() after which no more BQN changes are sent
+    self.bqnSessions = {}
+    self.bqnPrefetch = {}  # Future entries read in advance, by BQN URI root and entity
+    self.metrics = SyncMetrics()
+    self.journal = None
+    self.journalSeq = 0
+    self.journalLock = threading.Lock()
+    self.bqnName = None  # BQN in logs and metrics when several are updated
     logLevel = logging.WARNING
     if verbose == 1:
       logLevel = logging.INFO
     elif verbose > 1:
       logLevel = logging.DEBUG
-    if logFile:
-      logging.basicConfig(
-                    format='%(message)s',
-                    level=logLevel,
-                    encoding="utf-8",
-                    handlers=[logging.handlers.RotatingFileHandler(logFile, maxBytes=5*10**8, backupCount=10)]
-      )
-    else:
-      logging.basicConfig(stream=sys.stdout, format='%(message)s', level=logLevel, encoding="utf-8")
+    if not logging.getLogger().handlers:  # Not configured yet
+      if logFile:
+        handler = logging.handlers.RotatingFileHandler(logFile, maxBytes=5*10**8, backupCount=10, encoding="utf-8")
+      else:
+        handler = logging.StreamHandler(sys.stdout)
+      handler.setFormatter(logging.Formatter('%(message)s'))
+      # Written in a background thread, flushed at exit
+      logQueue = queue.Queue(BillingSync.LOG_QUEUE_SIZE)
+      listener = logging.handlers.QueueListener(logQueue, handler)
+      listener.start()
+      atexit.register(listener.stop)
+      logging.basicConfig(format='%(message)s', level=logLevel, handlers=[BoundedQueueHandler(logQueue)])
 
   ############################################################################
 
   def normalizeString(self, str):
-    return str.replace(' ', '_')
+    return BqnRecord.normalizeString(str)
 
   def normalize(self, obj):
     # Traverse object to replace strings for BQN normalized form
     # Object must be a dictionary or an array for the funtion to do anything
+    # BqnRecord objects are already normalized
     if isinstance(obj, dict):
       for key in obj:
         if isinstance(obj[key], str):
@@ -96,11 +630,11 @@ class BillingSync:
         else:
           self.normalize(obj[key])
     elif isinstance(obj, list):
-      for i in obj:
-        if isinstance(i, str):
-          obj[obj.index(i)] = self.normalizeString(i)
+      for i, item in enumerate(obj):
+        if isinstance(item, str):
+          obj[i] = self.normalizeString(item)
         else:
-          self.normalize(obj[obj.index(i)])
+          self.normalize(item)
     else:
       pass # Do nothing
  
@@ -136,8 +670,106 @@ class BillingSync:
  
   ############################################################################
 
+  def projectFields(self, obj, fields):
+    """
+    Returns a copy of a json object with only the fields in the fields
+    dictionary. A field maps to None to keep its whole value, or to a
+    dictionary of its subfields to keep. Lists are projected item by item.
+    Used to trim large records to the fields actually used.
+    """
+    if isinstance(obj, list):
+      return [self.projectFields(o, fields) for o in obj]
+    if not isinstance(obj, dict):
+      return obj
+    rsp = {}
+    for f in fields:
+      if f in obj:
+        rsp[f] = obj[f] if fields[f] is None else self.projectFields(obj[f], fields[f])
+    return rsp
+
+  def iterJsonArray(self, rsp, chunkSize=65536, hasher=None):
+    """
+    Generator of the items of a json array in an HTTP response body, decoded
+    as the response is received (the request must be made with stream=True).
+    If a hashlib hasher is given, it is updated with the body.
+    """
+    decoder = json.JSONDecoder()
+    if not rsp.encoding:
+      rsp.encoding = 'utf-8'
+    buf = ''
+    inArray = False
+    for chunk in rsp.iter_content(chunk_size=chunkSize, decode_unicode=True):
+      buf += chunk
+      if hasher:
+        hasher.update(chunk.encode('utf-8'))
+      pos = 0
+      while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+          pos += 1
+        if pos == len(buf):
+          break
+        if not inArray:
+          if buf[pos] != '[':
+            raise Exception("Response is not a json array")
+          inArray = True
+          pos += 1
+          continue
+        if buf[pos] == ']':
+          return
+        try:
+          item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:  # Item not complete yet, wait for more data
+          break
+        yield item
+      buf = buf[pos:]
+    if inArray:
+      raise Exception("Truncated json array in response")
+
+  ############################################################################
+
+  def compactAddresses(self, addresses, minAddresses):
+    """
+    Collapses the addresses of a list into CIDR ranges with at least
+    minAddresses. Returns the addresses not in a range and the ranges.
+    Strings that are not IP addresses are returned as they are.
+    """
+    ips = {4: [], 6: []}
+    rest = []
+    for a in addresses:
+      try:
+        ip = ipaddress.ip_address(a)
+      except ValueError:
+        rest.append(a)
+        continue
+      ips[ip.version].append(ip)
+    ranges = []
+    for version in ips:
+      for net in ipaddress.collapse_addresses(ips[version]):
+        if net.num_addresses >= minAddresses:
+          ranges.append(str(net))
+        else:
+          rest.extend(str(ip) for ip in net)
+    return rest, ranges
+
+  def compactSubscriberGroup(self, group):
+    # Contiguous members replaced by ranges, to reduce the size of group updates
+    if BillingSync.GROUP_RANGE_MIN_ADDRESSES < 1 or not group.get("subscriberMembers"):
+      return
+    members, ranges = self.compactAddresses(group["subscriberMembers"], BillingSync.GROUP_RANGE_MIN_ADDRESSES)
+    group["subscriberMembers"] = members
+    if ranges:
+      group["subscriberRanges"] = (group.get("subscriberRanges") or []) + ranges
+
+  ############################################################################
+
+  def jsonDefault(self, obj):
+    # To serialize BqnRecord objects as their BQN JSON entries
+    if isinstance(obj, BqnRecord):
+      return obj.toJson()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
   def jsonDumps(self, jsonObj):
-    return json.dumps(jsonObj, ensure_ascii=False).encode('utf-8')
+    return json.dumps(jsonObj, ensure_ascii=False, default=self.jsonDefault).encode('utf-8')
 
   ############################################################################
 
@@ -167,25 +799,65 @@ class BillingSync:
 
   ############################################################################
 
+  def getMetricsEndpoint(self, url):
+    # URL path, with BQN entry ids replaced by {id}
+    path = urllib.parse.urlparse(url).path
+    for collection in BillingSync.BQN_COLLECTIONS:
+      prefix = "/api/v1/" + collection + "/"
+      if path.startswith(prefix) and len(path) > len(prefix):
+        return prefix + "{id}"
+    return path
+
+  def observeResponse(self, rsp, *args, **kwargs):
+    """
+    Session response hook, records request latency and size in the metrics.
+    """
+    endpoint = self.getMetricsEndpoint(rsp.request.url)
+    self.metrics.observeRequest(rsp.request.method, endpoint, rsp.status_code, rsp.elapsed.total_seconds())
+    if rsp.request.body:
+      self.metrics.addPayload(endpoint, "sent", len(rsp.request.body))
+
+  def observePayload(self, rsp):
+    # Bytes received in a response, once its body has been read
+    if rsp is not None and hasattr(getattr(rsp, "raw", None), "tell"):
+      self.metrics.addPayload(self.getMetricsEndpoint(rsp.request.url), "received", rsp.raw.tell())
+
+  ############################################################################
+
+  def formatTable(self, headers, rows, maxWidths=None):
+    """
+    Text of a table with the headers and rows (lists of strings). Columns are
+    as wide as their longest value, up to maxWidths.
+    """
+    widths = [len(h) for h in headers]
+    for row in rows:
+      for i, value in enumerate(row):
+        if len(value) > widths[i]:
+          widths[i] = len(value)
+    if maxWidths:
+      widths = [min(w, m) for w, m in zip(widths, maxWidths)]
+    rowFormat = ''.join("{:<%d}" % (w + 1) for w in widths)
+    return '\n'.join(rowFormat.format(*row) for row in [headers] + rows)
+
+  def printTable(self, title, headers, rows, maxWidths=None):
+    # Logged as one record, to keep logging out of the synchronization time
+    self.logger.info("\n%s\n%s" % (title, self.formatTable(headers, rows, maxWidths)))
+
   def printEntries(self, entries, fields, title=''):
-    if title:
-      self.logger.info("\n" + title)
+    if not self.logger.isEnabledFor(logging.INFO):
+      return
 
-    tableSizes = []
     headers = []
+    maxWidths = []
     for f in fields:
       if isinstance(f, list): # path to subfield
-        tableSizes.append(20)
         headers.append(f[-1])
+        maxWidths.append(20)
       else:
-        tableSizes.append( min(50, len(max(list(str(x[f]) for x in entries) + [f], key=len))) )
         headers.append(f)
+        maxWidths.append(50)
 
-    rowFormat = ''
-    for size in tableSizes:
-      rowFormat += "{:<%d}" % (size + 1)
-    self.logger.info(rowFormat.format(*headers))
-
+    rows = []
     for e in entries:
       values = []
       for f in fields:
@@ -203,8 +875,9 @@ class BillingSync:
           val =  ','.join([str(x) for x in val])
         elif isinstance(val, dict):
           val =  ','.join([str(x) for x in val.items()])
-        values.append(val)
-      self.logger.info(rowFormat.format(*values))
+        values.append(str(val))
+      rows.append(values)
+    self.printTable(title, headers, rows, maxWidths)
 
   ############################################################################
 
@@ -212,28 +885,10 @@ class BillingSync:
     if not data or not "policies" in data or len(data["policies"]) == 0:
       self.logger.debug("No policies to print")
       return
+    if not self.logger.isEnabledFor(logging.INFO):
+      return
 
-    # Calculate size of columns as maximum length of the values to display
-    # When the column header may be wider than the displayed values, it is
-    # also considered.
-    # We create a list with the dictionary field values for each column, get the
-    # list item with the maximum length and finally get that length.
-    tableSizes = []
-    tableSizes.append( len( max(list(x["policyName"] for x in data["policies"]) + ["Policy"], key=len) ) )
-    tableSizes.append( len( max(list(str(x["policyId"]) for x in data["policies"] if "policyId" in x) + ["Policy-Id"], key=len) ) )
-    tableSizes.append( len( max(list(str(x["rateLimitDownlink"]["rate"]) for x in data["policies"] if "rateLimitDownlink" in x) + ["Dn-Kbps"], key=len) ) )
-    tableSizes.append( len( max(list(str(x["rateLimitUplink"]["rate"]) for x in data["policies"] if "rateLimitUplink" in x) + ["Up-Kbps"], key=len) ) )
-
-    rowFormat = ''
-    for size in tableSizes:
-      rowFormat += "{:<%d}" % (size + 1)
-    self.logger.info("\nPOLICIES\n" + rowFormat.format("Policy"
-                                      ,"Policy-Id"
-                                      ,"Dn-Kbps"
-                                      ,"Up-Kbps"
-                                      ))
-
-  
+    rows = []
     for p in data["policies"]:
       policyId = "n/a"
       rateLimitDownlink = "n/a"
@@ -246,12 +901,8 @@ class BillingSync:
       if "rateLimitUplink" in p:
         rateLimitUplink = p["rateLimitUplink"]["rate"]
 
-      self.logger.info(rowFormat.format(p["policyName"]
-                                        ,policyId
-                                        ,rateLimitDownlink
-                                        ,rateLimitUplink
-                                        ))
-
+      rows.append([p["policyName"], str(policyId), str(rateLimitDownlink), str(rateLimitUplink)])
+    self.printTable("POLICIES", ["Policy", "Policy-Id", "Dn-Kbps", "Up-Kbps"], rows)
 
   ############################################################################
 
@@ -259,25 +910,10 @@ class BillingSync:
     if not data or not "subscribers" in data or len(data["subscribers"]) == 0:
       self.logger.debug("No subscribers to print")
       return
+    if not self.logger.isEnabledFor(logging.INFO):
+      return
 
-    # Similar calculation of format as in print Policies
-    tableSizes = []
-    tableSizes.append( len( max(list(x["subscriberIp"] for x in data["subscribers"]), key=len) ) )
-    tableSizes.append( len( max(list(x["policyRate"] for x in data["subscribers"] if "policyRate" in x) + ["Policy"], key=len) ) )
-    tableSizes.append( max(len( max(list(str(x["state"]) for x in data["subscribers"]), key=len) ), len("state") ) )
-    tableSizes.append( len("Block") )
-    tableSizes.append( len( max(list(str(x["subscriberId"]) for x in data["subscribers"] if "subscriberId" in x), key=len) ) )
-
-    rowFormat = ''
-    for size in tableSizes:
-      rowFormat += "{:<%d}" % (size + 1)
-    self.logger.info("\nSUBSCRIBERS\n" + rowFormat.format("IP"
-                                      ,"Policy"
-                                      ,"State"
-                                      ,"Block"
-                                      ,"Name"))
-
-  
+    rows = []
     for s in data["subscribers"]:
       subscriberId = "n/a"
       block = "n/a"
@@ -293,11 +929,8 @@ class BillingSync:
       if "policyRate" in s:
         policyName =  s["policyRate"]
 
-      self.logger.info(rowFormat.format(s["subscriberIp"]
-                                        ,policyName
-                                        ,state
-                                        ,block
-                                        ,subscriberId))
+      rows.append([s["subscriberIp"], policyName, str(state), block, str(subscriberId)])
+    self.printTable("SUBSCRIBERS", ["IP", "Policy", "State", "Block", "Name"], rows)
 
   ############################################################################
 
@@ -305,30 +938,19 @@ class BillingSync:
     if not data or not "subscriberGroups" in data or len(data["subscriberGroups"]) == 0:
       self.logger.debug("No subscriber groups to print")
       return
+    if not self.logger.isEnabledFor(logging.INFO):
+      return
 
-    # Similar calculation of format as in print Policies
-    tableSizes = []
-    tableSizes.append( len( max(list(x["subscriberGroupName"] for x in data["subscriberGroups"]) + ["Group"], key=len) ) )
-    tableSizes.append( len( max(list(x["policyRate"] for x in data["subscriberGroups"] if "policyRate" in x) + ["Policy"], key=len) ) )
-    tableSizes.append( 48 ) #  maximum length of a IPv6 address
-
-    rowFormat = ''
-    for size in tableSizes:
-      rowFormat += "{:<%d}" % (size + 1)
-    self.logger.info("\nSUBSCRIBER GROUPS\n" + rowFormat.format("Group", "Policy", "Member-IP/Range"))
-
+    rows = []
     for sg in data["subscriberGroups"]:
       policyRate = sg["policyRate"] if "policyRate" in sg else "n/a"
       if "subscriberMembers" in sg:
         for ip in sg["subscriberMembers"]:
-          self.logger.info(rowFormat.format(sg["subscriberGroupName"],
-                                          policyRate,
-                                          str(ip)))
+          rows.append([sg["subscriberGroupName"], policyRate, str(ip)])
       if "subscriberRanges" in sg:
         for ip in sg["subscriberRanges"]:
-          self.logger.info(rowFormat.format(sg["subscriberGroupName"],
-                                          policyRate,
-                                          str(ip)))
+          rows.append([sg["subscriberGroupName"], policyRate, str(ip)])
+    self.printTable("SUBSCRIBER GROUPS", ["Group", "Policy", "Member-IP/Range"], rows)
 
   ############################################################################
 
@@ -337,218 +959,515 @@ class BillingSync:
     self.printSubscribers(data)
     self.printSubscriberGroups(data)
 
+  def exportData(self, data, exportDir):
+    """
+    Writes billing data to files in exportDir: policies.csv, subscribers.csv
+    and subscriberGroups.jsonl (a JSON entry per line).
+    """
+    os.makedirs(exportDir, exist_ok=True)
+    with open(os.path.join(exportDir, "policies.csv"), "w", newline='', encoding="utf-8") as f:
+      writer = csv.writer(f)
+      writer.writerow(["policyName", "policyId", "rateLimitDownlink", "rateLimitUplink"])
+      for p in data.get("policies", []):
+        writer.writerow([p["policyName"], p.get("policyId"),
+                         p["rateLimitDownlink"]["rate"] if "rateLimitDownlink" in p else None,
+                         p["rateLimitUplink"]["rate"] if "rateLimitUplink" in p else None])
+    with open(os.path.join(exportDir, "subscribers.csv"), "w", newline='', encoding="utf-8") as f:
+      writer = csv.writer(f)
+      fields = ["subscriberIp", "subscriberId", "policyRate", "state", "block"]
+      writer.writerow(fields)
+      for sub in data.get("subscribers", []):
+        writer.writerow([sub.get(field) for field in fields])
+    with open(os.path.join(exportDir, "subscriberGroups.jsonl"), "w", encoding="utf-8") as f:
+      for sg in data.get("subscriberGroups", []):
+        f.write(json.dumps(sg, ensure_ascii=False, default=self.jsonDefault) + '\n')
+
   ############################################################################
 
-  def areEqual(self, a, b, keys=None, excluded=[]):
-    # Compare two variables for equality.
-    # "keys" argument restrict operation to those dictionary keys, excluding those
-    # in "excluded" (possibly children fields of keys)
-    # If "keys" is none, all fields checked for equality, except "excluded".
-    if isinstance(a, list) and isinstance(b, list):
-      return sorted(a) == sorted(b)
-    elif isinstance(a, dict) and isinstance(b, dict):
-      if not keys:
-        keysA = sorted([k for k in a.keys() if k not in excluded])
-        keysB = sorted([k for k in b.keys() if k not in excluded])
-        if keysA != keysB:
-          return False
-        else:
-          keys = keysA
-      # Check if dictionaries have item as key
-      for k in keys:
-        if k in excluded:
-          continue
-        if k not in a and k not in b:
-          continue
-        elif k not in a and k in b:
-          if not b[k]:
-            continue
-          else:
-            return False
-        elif k in a and k not in b:
-          if not a[k]:
-            continue
-          else:
-            return False
-        elif not self.areEqual(a[k], b[k], excluded=excluded):
-          return False
-      return True
+  def getCanonical(self, value, excluded):
+    if isinstance(value, dict):
+      return {k: self.getCanonical(value[k], excluded) for k in value if k not in excluded}
+    elif isinstance(value, list):
+      # Order not relevant
+      return sorted(json.dumps(self.getCanonical(v, excluded), sort_keys=True) for v in value)
+    elif isinstance(value, float) and value.is_integer():
+      return int(value)
     else:
-      return a == b
+      return value
+
+  def getFingerprint(self, entry, fields, excluded=[]):
+    """
+    Digest of the fields of an entry, to compare it with another in constant
+    time. Missing and empty fields are the same, lists are compared regardless
+    of their order and subfields in "excluded" are ignored.
+    """
+    canonical = {f: self.getCanonical(entry[f], excluded) for f in fields if entry.get(f)}
+    return hashlib.blake2b(json.dumps(canonical, sort_keys=True).encode('utf-8'), digest_size=16).digest()
 
   ############################################################################
 
   def bqnApiRest(self, session, method, uri, id, entry=None):
+    if method == 'get':
+      return self.bqnApiRequest(session, method, uri, id, entry)
+    # Writes are journaled and, during a BQN update, sent by the concurrent executor
+    seq = self.journalOperation(method, uri, id, entry)
+    if self.bqnWriter:
+      self.bqnWriter.submit(self.bqnApiWrite, seq, session, method, uri, id, entry)
+      return None
+    return self.bqnApiWrite(seq, session, method, uri, id, entry)
+
+  def bqnApiWrite(self, seq, session, method, uri, id, entry=None):
+    rsp = self.bqnApiRequest(session, method, uri, id, entry)
+    # A retried request may find its first attempt already done in BQN (with
+    # its response lost), and a resumed update does not know it either
+    if rsp is not None and method == 'post' and rsp.status_code == 409:
+      self.logger.info("%s already in BQN, updated instead" % (uri+id))
+      rsp = self.bqnApiRequest(session, 'put', uri, id, entry)
+    elif rsp is not None and method == 'delete' and rsp.status_code == 404:
+      self.logger.info("%s already deleted in BQN" % (uri+id))
+      return rsp
+    if rsp is not None and rsp.status_code < 300:
+      self.journalDone(seq)
+    else:
+      self.bqnErrors.append("%s %s" % (method, uri+id))
+    return rsp
+
+  def bqnApiRequest(self, session, method, uri, id, entry=None):
+    """
+    Sends a BQN REST request, retrying up to BQN_RETRIES times with increasing
+    delays if there is a connection error or a transient error status.
+    """
     safeId = requests.utils.quote(id, safe='')  # Empty safe char list, so / is not regarded as safe and encoded as well
 
-    try:
-      if method == 'post':
-        rsp = session.post(uri + safeId, data=self.jsonDumps(entry))
-        self.printResponseDetails(rsp)
-      elif method == 'put':
-        rsp = session.put(uri + safeId, data=self.jsonDumps(entry))
-        self.printResponseDetails(rsp)
-      elif method == 'get':
-        rsp = session.get(uri + safeId)
-        self.printResponseDetails(rsp)
-      elif method == 'delete':
-        rsp = session.delete(uri + safeId)
-        self.printResponseDetails(rsp)
-      else:
-        self.logger.debug("Unknown BQN API REST method %s" % method)
-    except Exception as e:
-      self.logger.error("Error in %s to %s. Exception %s" % (method, uri+safeId, e))
+    for attempt in range(BillingSync.BQN_RETRIES + 1):
+      if attempt > 0:
+        delay = BillingSync.BQN_RETRY_DELAY * 2**(attempt - 1) * random.uniform(0.8, 1.2)
+        self.logger.info("Retry %d of %s to %s in %.1f seconds" % (attempt, method, uri+safeId, delay))
+        time.sleep(delay)
+      rsp = None
+      error = None
+      try:
+        if method == 'post':
+          rsp = session.post(uri + safeId, data=self.jsonDumps(entry), timeout=self.requestTimeout)
+          self.printResponseDetails(rsp)
+        elif method == 'put':
+          rsp = session.put(uri + safeId, data=self.jsonDumps(entry), timeout=self.requestTimeout)
+          self.printResponseDetails(rsp)
+        elif method == 'get':
+          rsp = session.get(uri + safeId, timeout=self.requestTimeout)
+          self.printResponseDetails(rsp)
+        elif method == 'delete':
+          rsp = session.delete(uri + safeId, timeout=self.requestTimeout)
+          self.printResponseDetails(rsp)
+        else:
+          self.logger.debug("Unknown BQN API REST method %s" % method)
+          return None
+      except Exception as e:
+        error = e
+      self.observePayload(rsp)
+      if rsp is not None and rsp.status_code not in BillingSync.BQN_TRANSIENT_STATUS:
+        break
 
-  ############################################################################
+    if error:
+      self.logger.error("Error in %s to %s. Exception %s" % (method, uri+safeId, error))
+    return rsp
 
-  def updateBqnPolicies(self, uriRoot, session, data):
-    creations = 0
-    modifications = 0
-    deletions = 0
-    polsInBqn = {}
+  def waitBqnWrites(self):
+    if self.bqnWriter:
+      self.bqnWriter.wait()
 
-    if not "policies" in data or len(data["policies"]) == 0:
-      self.logger.debug("No policy information to update")
-      return
+  ############################################################################
 
-    rsp = session.get(uriRoot + "/policies/rate")
-    if rsp.status_code == 200:
-      for p in rsp.json()["items"]:
-        polsInBqn[p["policyName"]] = {"policy": p, "inBilling": False}
+  def openJournal(self, journalFile, uriRoot):
+    self.journal = open(journalFile, "w", encoding="utf-8")
+    self.journalSeq = 0
+    snapshot = self.syncState.get("saved") if self.syncState else None
+    self.writeJournal({"bqn": uriRoot, "snapshot": snapshot, "start": time.time()})
+
+  def writeJournal(self, record):
+    # Flushed so that it survives an interruption of this process
+    with self.journalLock:
+      self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=self.jsonDefault) + '\n')
+      self.journal.flush()
+
+  def journalOperation(self, method, uri, id, entry):
+    if not self.journal:
+      return None
+    with self.journalLock:
+      self.journalSeq += 1
+      seq = self.journalSeq
+    self.writeJournal({"op": seq, "method": method, "uri": uri, "id": id, "entry": entry})
+    return seq
+
+  def journalDone(self, seq):
+    if self.journal and seq:
+      self.writeJournal({"done": seq})
+
+  def closeJournal(self):
+    if self.journal:
+      self.journal.close()
+      self.journal = None
+
+  def resumeJournal(self, journalFile, uriRoot):
+    """
+    Applies to the sync state snapshot the operations completed by an update
+    that did not finish (interrupted or with failed operations), as recorded in
+    its journal. Its pending operations are then found again by this update,
+    that sends only those. The journal must have been started from this snapshot.
+    """
+    header = None
+    operations = {}
+    done = set()
+    with open(journalFile, encoding="utf-8") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:  # Last line may be incomplete
+          continue
+        if header is None:
+          header = record
+        elif "op" in record:
+          operations[record["op"]] = record
+        elif "done" in record:
+          done.add(record["done"])
+    if not header or header["bqn"] != uriRoot or header["snapshot"] != self.syncState.get("saved"):
+      self.logger.info("Journal %s not from the current sync state, ignored" % journalFile)
+      return
 
-    self.logger.info("%s start synchronization of policies into %s" % (datetime.datetime.now(), uriRoot))
-    for p in data["policies"]:
-      if not p["policyName"] in polsInBqn:
-        self.logger.debug("Create policy %s" % p["policyId"])
-        self.bqnApiRest(session, 'post', uriRoot + "/policies/rate/", p["policyName"], p)
-        polsInBqn[p["policyName"]] = {"policy": p, "inBilling": True}
-        creations += 1
+    entries = {}
+    for kind in BillingSync.STATE_FIELDS:
+      if kind in self.syncState:
+        keyField = BillingSync.STATE_FIELDS[kind][0]
+        entries[kind] = {e[keyField]: e for e in self.syncState[kind]}
+    kindsByUri = {uriRoot + BillingSync.SYNC_KINDS[k]["path"]: k for k in BillingSync.SYNC_KINDS}
+    for seq in sorted(done):
+      op = operations.get(seq)
+      kind = kindsByUri.get(op["uri"]) if op else None
+      if kind not in entries:
+        continue
+      keyField = BillingSync.SYNC_KINDS[kind]["key"]
+      if op["method"] == 'delete':
+        entries[kind].pop(op["id"], None)
       else:
-        match = polsInBqn[p["policyName"]]["policy"]
-        polsInBqn[p["policyName"]]["inBilling"] = True
-        if not self.areEqual(match, p, keys=["policyId", "rateLimitDownlink", "rateLimitUplink"], excluded=["congestionMgmt"]):
-          self.logger.debug("Policy changed. In BQN: %s" % match)
-          self.logger.debug("            In Billing: %s" % p)
-          self.logger.debug("Modify policy %s" % p["policyName"])
-          self.bqnApiRest(session, 'put', uriRoot + "/policies/rate/", p["policyName"], p)
-          modifications += 1
-
-    # Generate a block policy to enforce inactive clients
-    if not BillingSync.BLOCK_POLICY in polsInBqn:
-      payload = self.jsonDumps({"policyId": "block", "rateLimitDownlink": {"rate": 0}, "rateLimitUplink": {"rate": 0}})
-      rsp = session.post(uriRoot + "/policies/rate/" + BillingSync.BLOCK_POLICY, data=payload)
-      self.printResponseDetails(rsp)
-
-    # Delete policies no longer in billing (except blocking)
-    for key in polsInBqn:
-      if key != BillingSync.BLOCK_POLICY and not polsInBqn[key]["inBilling"]:
-        self.bqnApiRest(session, 'delete', uriRoot + "/policies/rate/", key)
-        deletions += 1
-
-    self.logger.warning("%s policy synchronization: %d created, %d updated and %d deleted" % \
-                        (datetime.datetime.now(), creations, modifications, deletions))
+        default = {"policyAssignedBy": BillingSync.STATE_ASSIGNED_BY} if kind == "subscribers" else {}
+        entry = dict(entries[kind].get(op["id"], default))
+        entry.update(op["entry"])
+        entry[keyField] = op["id"]
+        entries[kind][op["id"]] = entry
+    for kind in entries:
+      self.syncState[kind] = list(entries[kind].values())
+    self.logger.warning("%s %sresuming synchronization: %d operations done, %d pending" % \
+                        (datetime.datetime.now(), self.getBqnLabel(), len(done), len(operations) - len(done)))
 
   ############################################################################
 
-  def updateBqnSubscribers(self, uriRoot, session, data):
-    creations = 0
-    modifications = 0
-    deletions = 0
-    subsInBqn = {}
-
-    if not "subscribers" in data or len(data["subscribers"]) == 0:
-      self.logger.debug("No subscriber information to update")
-      return
-
-    rsp = session.get(uriRoot + "/subscribers")
-    if rsp.status_code == 200:
-      for s in rsp.json()["items"]:
-        subsInBqn[s["subscriberIp"]] = {"subscriber": s, "inBilling": False}
-
-    self.logger.info("%s start synchronization of subscribers into %s" % (datetime.datetime.now(), uriRoot))
-    for s in data["subscribers"]:
-      if not s["subscriberIp"] in subsInBqn:
-        self.logger.debug("Create subscriber %s" % s["subscriberIp"])
-        self.bqnApiRest(session, 'post', uriRoot + "/subscribers/", s["subscriberIp"], s)
-        subsInBqn[s["subscriberIp"]] = {"subscriber": s, "inBilling": True}
-        creations += 1
+  def loadSyncState(self, stateFile, uriRoot, fullSyncHours):
+    """
+    Returns the snapshot of the BQN contents saved by the last run, or None
+    if BQN must be read in full (no snapshot, a different BQN or a periodic
+    full reconciliation due).
+    """
+    try:
+      with open(stateFile, encoding="utf-8") as f:
+        state = json.load(f)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      self.logger.warning("Cannot read sync state %s (%s), BQN read in full" % (stateFile, e))
+      return None
+    if state.get("bqn") != uriRoot:
+      self.logger.info("Sync state of a different BQN (%s), BQN read in full" % state.get("bqn"))
+      return None
+    if time.time() - state.get("lastFullSync", 0) >= fullSyncHours*3600:
+      self.logger.info("Periodic full reconciliation with BQN")
+      return None
+    return state
+
+  def saveSyncState(self, stateFile, uriRoot, lastFullSync, saved=None):
+    state = {"bqn": uriRoot, "lastFullSync": lastFullSync, "saved": saved or time.time()}
+    shard = self.syncShard if self.syncShard is not None else (self.syncState or {}).get("shard")
+    if shard is not None:
+      state["shard"] = shard
+    for kind in BillingSync.STATE_FIELDS:
+      fields = BillingSync.STATE_FIELDS[kind]
+      if kind in self.newSyncState:
+        entries = self.newSyncState[kind]
+      elif self.syncState and kind in self.syncState:
+        entries = self.syncState[kind]  # Not updated in this run
       else:
-        match = subsInBqn[s["subscriberIp"]]["subscriber"]
-        subsInBqn[s["subscriberIp"]]["inBilling"] = True        
-        # If no policy in billing and assigned by rules in BQN, no update of policy needed
-        if not s["policyRate"] and "policyAssignedBy" in match and match["policyAssignedBy"] == 'rules':
-          if not self.areEqual(match, s, ["subscriberId"]):
-            self.logger.debug("Subscriber changed. In BQN: %s" % match)
-            self.logger.debug("                In Billing: %s" % s)
-            self.logger.debug("Modify ID of subscriber %s" % s["subscriberIp"])
-            self.bqnApiRest(session, 'put', uriRoot + "/subscribers/", s["subscriberIp"], s)
-            modifications += 1
-        elif not self.areEqual(match, s, ["subscriberId", "policyRate"]):
-          self.logger.debug("Subscriber changed. In BQN: %s" % match)
-          self.logger.debug("                In Billing: %s" % s)
-          self.logger.debug("Modify subscriber %s" % s["subscriberIp"])
-          self.bqnApiRest(session, 'put', uriRoot + "/subscribers/", s["subscriberIp"], s)
-          modifications += 1
-
-    # Delete subscribers no longer in billing that has no rules policy
-    for key in subsInBqn:
-      if not subsInBqn[key]["inBilling"] and \
-        "policyAssignedBy" in subsInBqn[key]["subscriber"] and \
-        subsInBqn[key]["subscriber"]["policyAssignedBy"] != "rules":
-        self.bqnApiRest(session, 'delete', uriRoot + "/subscribers/", key)
-        deletions += 1
-
-    self.logger.warning("%s subscriber synchronization: %d created, %d updated and %d deleted" % \
-                        (datetime.datetime.now(), creations, modifications, deletions))
+        continue
+      state[kind] = [{f: e[f] for f in fields if f in e} for e in entries]
+    tmpFile = stateFile + ".tmp"
+    with open(tmpFile, "w", encoding="utf-8") as f:
+      json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmpFile, stateFile)
+
+  def getBqnEntries(self, uriRoot, session, query, kind):
+    # Entries in the last snapshot if available, in BQN otherwise
+    if self.syncState and kind in self.syncState:
+      self.logger.info("%s %s taken from sync state" % (datetime.datetime.now(), kind))
+      return self.syncState[kind]
+    prefetch = self.bqnPrefetch.pop((uriRoot, kind), None)
+    if prefetch:
+      try:
+        return prefetch.result()
+      except Exception as e:
+        self.logger.info("%s %s read in advance failed (%s), read again" % (datetime.datetime.now(), kind, e))
+    return self.readBqnCollection(uriRoot, session, query, kind)
+
+  def readBqnCollection(self, uriRoot, session, query, kind):
+    with self.metrics.phase(self.getPhase("read_" + kind)):
+      rsp = self.bqnApiRequest(session, 'get', uriRoot + query, '')
+      if rsp is None:
+        raise Exception("Cannot read %s from BQN" % kind)
+      if rsp.status_code == 200:
+        return rsp.json()["items"]
+    return []
 
   ############################################################################
 
-  def updateBqnSubscriberGroups(self, uriRoot, session, data):
-    creations = 0
-    modifications = 0
-    deletions = 0
-    sgsInBqn = {}
+  def getBlockPolicy(self):
+    return {"policyId": "block", "rateLimitDownlink": {"rate": 0}, "rateLimitUplink": {"rate": 0}}
+
+  def getSyncFields(self, kind, inBqn, inBilling):
+    # If no policy in billing and assigned by rules in BQN, no update of policy needed
+    if kind == "subscribers" and not inBilling["policyRate"] and inBqn.get("policyAssignedBy") == 'rules':
+      return ["subscriberId"]
+    return BillingSync.SYNC_KINDS[kind]["fields"]
+
+  def isBqnDeletable(self, kind, key, inBqn):
+    # Block policy, group of all subscribers and subscribers with a policy
+    # assigned by BQN rules are kept when not in billing
+    if kind == "policies":
+      return key != BillingSync.BLOCK_POLICY
+    elif kind == "subscribers":
+      return "policyAssignedBy" in inBqn and inBqn["policyAssignedBy"] != "rules"
+    else:
+      return key != "all-subscribers"
 
-    if not "subscriberGroups" in data or len(data["subscriberGroups"]) == 0:
-      self.logger.debug("No subscriber group information to update")
-      return
+  def planBqnUpdate(self, uriRoot, session, data, kind):
+    """
+    Plans the creations, updates and deletions in a BQN collection ("policies",
+    "subscribers" or "subscriberGroups") to make it equal to billing, comparing
+    the fingerprints of their entries. Returns None if billing has no entries
+    of that kind, so BQN is left as it is.
+    """
+    spec = BillingSync.SYNC_KINDS[kind]
+    keyField = spec["key"]
+    if not kind in data or len(data[kind]) == 0:
+      self.logger.debug("No %s information to update" % spec["name"])
+      return None
+
+    inBqn = {}
+    for e in self.getBqnEntries(uriRoot, session, spec["path"].rstrip('/'), kind):
+      inBqn[e[keyField]] = e
+
+    with self.metrics.phase(self.getPhase("plan_" + kind)):
+      plan = SyncPlan(kind, spec["path"])
+      plan.current = inBqn
+      for b in data[kind]:
+        key = b[keyField]
+        # An entry repeated in billing is compared with the previous one
+        current = plan.state.get(key, inBqn.get(key))
+        if current is None:
+          plan.add('post', key, b)
+          entry = dict(b)
+          if kind == "subscribers":
+            entry["policyAssignedBy"] = BillingSync.STATE_ASSIGNED_BY
+          plan.state[key] = entry
+          continue
+        fields = self.getSyncFields(kind, current, b)
+        if self.getFingerprint(current, fields, spec["excluded"]) != self.getFingerprint(b, fields, spec["excluded"]):
+          self.logger.debug("%s changed. In BQN: %s" % (spec["name"].capitalize(), current))
+          self.logger.debug("In Billing: %s" % b)
+          plan.add('put', key, b)
+        entry = dict(current)
+        entry.update(b)
+        plan.state[key] = entry
+
+      # Generate a block policy to enforce inactive clients
+      if kind == "policies" and not BillingSync.BLOCK_POLICY in plan.state and not BillingSync.BLOCK_POLICY in inBqn:
+        blockPolicy = self.getBlockPolicy()
+        plan.add('post', BillingSync.BLOCK_POLICY, blockPolicy)
+        plan.state[BillingSync.BLOCK_POLICY] = dict(blockPolicy, policyName=BillingSync.BLOCK_POLICY)
+
+      # Delete entries no longer in billing
+      for key in inBqn:
+        if key in plan.state:
+          continue
+        if self.isBqnDeletable(kind, key, inBqn[key]):
+          plan.add('delete', key)
+        else:
+          plan.state[key] = inBqn[key]
+      if kind == "subscribers":
+        # Stable, so each class keeps the billing order
+        priorities = BillingSync.SUBSCRIBER_PRIORITIES
+        plan.operations.sort(key=lambda o: priorities.index(self.getBqnPriority(plan, o)))
 
-    rsp = session.get(uriRoot + "/subscriberGroups")
-    if rsp.status_code == 200:
-      for sg in rsp.json()["items"]:
-        sgsInBqn[sg["subscriberGroupName"]] = {"group": sg, "inBilling": False}
+    return plan
 
-    self.logger.info("%s start synchronization of subscriber groups into %s" % (datetime.datetime.now(), uriRoot))
-    for sg in data["subscriberGroups"]:
-      if not sg["subscriberGroupName"] in sgsInBqn:
-        self.logger.debug("Create subscriber group %s" % sg["subscriberGroupName"])
-        self.bqnApiRest(session, 'post', uriRoot + "/subscriberGroups/", sg["subscriberGroupName"], sg)
-        sgsInBqn[sg["subscriberGroupName"]] = {"group": sg, "inBilling": True}
-        creations += 1
+  def getShard(self, key, shards):
+    # Stable among runs and processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=4).digest(), "big") % shards
+
+  def restrictBqnPlan(self, plan, shards, firstShard):
+    """
+    Restricts a plan to the operations of one of shards groups of keys (by key
+    hash): the first with operations from firstShard on, in rotation. Entries of
+    the operations left out are kept in the plan state as they are in BQN.
+    Returns the shard kept (None if the plan has no operations) and the number
+    of operations left out, to be sent in later updates.
+    """
+    byShard = {}
+    for operation in plan.operations:
+      byShard.setdefault(self.getShard(operation[1], shards), []).append(operation)
+    if not byShard:
+      return None, 0
+    shard = next(s % shards for s in range(firstShard, firstShard + shards) if s % shards in byShard)
+    plan.operations = byShard.pop(shard)
+    pending = 0
+    for operations in byShard.values():
+      self.deferBqnOperations(plan, operations)
+      pending += len(operations)
+    return shard, pending
+
+  def deferBqnOperations(self, plan, operations):
+    # Entries of operations not sent are kept in the plan state as in BQN
+    for method, key, entry in operations:
+      if key in plan.current:
+        plan.state[key] = plan.current[key]
       else:
-        match = sgsInBqn[sg["subscriberGroupName"]]["group"]
-        sgsInBqn[sg["subscriberGroupName"]]["inBilling"] = True        
-        if not self.areEqual(match, sg, ["subscriberMembers", "subscriberRanges", "policyRate"]):
-          self.logger.debug("Group changed. In BQN: %s" % match)
-          self.logger.debug("           In Billing: %s" % sg)
-          self.logger.debug("Modify group %s" % sg["subscriberGroupName"])
-          self.bqnApiRest(session, 'put', uriRoot + "/subscriberGroups/", sg["subscriberGroupName"], sg)
-          modifications += 1
-
-    # Delete groups no longer in billing
-    for key in sgsInBqn:
-      if not sgsInBqn[key]["inBilling"] and key != "all-subscribers":
-        self.bqnApiRest(session, 'delete', uriRoot + "/subscriberGroups/", key)
-        deletions += 1
-
-    self.logger.warning("%s subscriber group synchronization: %d created, %d updated and %d deleted" % \
-                        (datetime.datetime.now(), creations, modifications, deletions))
+        plan.state.pop(key, None)
+        plan.deferred.add(key)
+
+  def restrictGroupMembers(self, groups, excluded):
+    """
+    Subscriber groups without the addresses in excluded (subscribers not in
+    BQN yet), as members or in ranges. Ranges with any of them are split in
+    the addresses left, compacted again. Groups with none are kept as they are.
+    """
+    excludedIps = {4: [], 6: []}
+    for address in excluded:
+      try:
+        ip = ipaddress.ip_address(address)
+      except ValueError:
+        continue
+      excludedIps[ip.version].append(int(ip))
+    for version in excludedIps:
+      excludedIps[version].sort()
+    restricted = []
+    for group in groups:
+      members = group.get("subscriberMembers") or []
+      ranges = []
+      expanded = []
+      for r in group.get("subscriberRanges") or []:
+        net = ipaddress.ip_network(r, strict=False)
+        ips = excludedIps[net.version]
+        first = bisect.bisect_left(ips, int(net.network_address))
+        if first < len(ips) and ips[first] <= int(net.broadcast_address):
+          expanded.extend(str(ip) for ip in net)
+        else:
+          ranges.append(r)
+      if not expanded and not any(m in excluded for m in members):
+        restricted.append(group)
+        continue
+      group = dict(group)
+      rest, newRanges = self.compactAddresses([a for a in expanded if a not in excluded], BillingSync.GROUP_RANGE_MIN_ADDRESSES)
+      group["subscriberMembers"] = [m for m in members if m not in excluded] + rest
+      group["subscriberRanges"] = ranges + newRanges
+      restricted.append(group)
+    return restricted
+
+  def isPastDeadline(self):
+    return self.deadline is not None and time.monotonic() >= self.deadline
+
+  def getBqnPriority(self, plan, operation):
+    """
+    Class of an operation of a subscriber plan (see SUBSCRIBER_PRIORITIES),
+    comparing it with the entry in BQN before the plan. None for other plans.
+    """
+    if plan.kind != "subscribers":
+      return None
+    method, key, entry = operation
+    if method == 'delete':
+      return "delete"
+    current = plan.current.get(key)
+    blocked = entry["policyRate"] == BillingSync.BLOCK_POLICY
+    if current is None:
+      return "block" if blocked else "policy"
+    if blocked != (current.get("policyRate") == BillingSync.BLOCK_POLICY):
+      return "block"
+    if "policyRate" in self.getSyncFields(plan.kind, current, entry) and entry["policyRate"] != current.get("policyRate"):
+      return "policy"
+    return "id"
+
+  def applyBqnPlan(self, uriRoot, session, plan):
+    spec = BillingSync.SYNC_KINDS[plan.kind]
+    with self.metrics.phase(self.getPhase("apply_" + plan.kind)):
+      self.logger.info("%s start synchronization of %s into %s" % (datetime.datetime.now(), spec["plural"], uriRoot))
+      # Operations already in priority order. Each class is a phase of its own,
+      # its time being the delay of its changes.
+      undone = []
+      for priority, operations in itertools.groupby(plan.operations, lambda o: self.getBqnPriority(plan, o)):
+        operations = list(operations)
+        if self.isPastDeadline():
+          undone.extend(operations)
+          continue
+        phase = self.getPhase("apply_%s_%s" % (plan.kind, priority)) if priority else None
+        if phase:
+          self.metrics.start(phase)
+        count = 0
+        for method, key, entry in operations:
+          # Operations already sent are completed, the rest left for the next update
+          if self.isPastDeadline():
+            undone.extend(operations[count:])
+            break
+          self.logger.debug("%s %s %s" % (method.capitalize(), spec["name"], key))
+          self.bqnApiRest(session, method, uriRoot + plan.path, key, entry)
+          count += 1
+        self.waitBqnWrites()
+        if phase:
+          self.metrics.stop(phase)
+          self.logger.info("%s %s%d %s %s changes sent" % (datetime.datetime.now(), self.getBqnLabel(),
+                                                            count, spec["name"], priority))
+    if undone:
+      self.deferBqnOperations(plan, undone)
+      self.bqnPending += len(undone)
+      undoneIds = set(map(id, undone))
+      plan.operations = [o for o in plan.operations if id(o) not in undoneIds]
+      self.logger.warning("%s %sdeadline reached, %d %s changes left to next synchronization (%d to create, %d to update and %d to delete)" % \
+                          (datetime.datetime.now(), self.getBqnLabel(), len(undone), spec["name"],
+                           sum(1 for o in undone if o[0] == 'post'), sum(1 for o in undone if o[0] == 'put'),
+                           sum(1 for o in undone if o[0] == 'delete')))
+    # Recorded to be saved in the snapshot
+    self.newSyncState[plan.kind] = list(plan.state.values())
+
+    self.logger.warning("%s %s%s synchronization: %d created, %d updated and %d deleted" % \
+                        (datetime.datetime.now(), self.getBqnLabel(), spec["name"],
+                         plan.count('post'), plan.count('put'), plan.count('delete')))
+
+  def printPlan(self, uriRoot, plan):
+    spec = BillingSync.SYNC_KINDS[plan.kind]
+    self.logger.warning("%s %s%s synchronization planned (not applied): %d to create, %d to update and %d to delete" % \
+                        (datetime.datetime.now(), self.getBqnLabel(), spec["name"],
+                         plan.count('post'), plan.count('put'), plan.count('delete')))
+    for method, key, entry in plan.operations:
+      self.logger.warning("%-6s %s%s %s" % (method.upper(), uriRoot + plan.path, key,
+                                            json.dumps(entry, ensure_ascii=False, default=self.jsonDefault) if entry else ''))
 
   ############################################################################
 
-  def updateBqn(self, bqnIp, bqnUser, bqnPassword, data):
+  def getBqnUriRoot(self, bqnIp):
+    return "https://" + bqnIp + ":3443/api/v1"
 
-    uriRoot = "https://" + bqnIp + ":3443/api/v1"
+  def getBqnSession(self, uriRoot, bqnUser, bqnPassword):
+    """
+    Session to a BQN, kept between updates so connections are reused when
+    running as a daemon.
+    """
+    key = (uriRoot, bqnUser, bqnPassword)
+    if key in self.bqnSessions:
+      return self.bqnSessions[key]
     session = requests.Session()
     session.verify = False
     session.auth = (bqnUser, bqnPassword)
@@ -557,24 +1476,422 @@ class BillingSync:
       "Accept-Charset": "utf-8"
     }
     # To support TLS1.2 (python default too stringent)
+    # Connection pool sized for the maximum number of concurrent requests
     if int(PY_VERSION[1]) >= 7:  # 3.7 or more
-      session.mount(uriRoot, BqnRestAdapter())
+      session.mount(uriRoot, BqnRestAdapter(pool_maxsize=BillingSync.BQN_MAX_REQUESTS))
+    else:
+      session.mount(uriRoot, HTTPAdapter(pool_maxsize=BillingSync.BQN_MAX_REQUESTS))
+    session.hooks["response"].append(self.observeResponse)
+    self.bqnSessions[key] = session
+    return session
+
+  def getBqnLabel(self):
+    return "BQN %s " % self.bqnName if self.bqnName else ""
+
+  def getPhase(self, phase):
+    return "%s/%s" % (self.bqnName, phase) if self.bqnName else phase
 
-    # Adapt data to BQN format
-    for item in data["policies"] + data["subscribers"] + data["subscriberGroups"]:
-      self.normalize(item)
+  def getBqnSync(self, bqnIp):
+    """
+    Copy of this object to update one of several BQNs in a thread of its own.
+    It shares logger, metrics and sessions, with its own update state.
+    """
+    bqnSync = copy.copy(self)
+    bqnSync.bqnWriter = None
+    bqnSync.bqnErrors = []
+    bqnSync.syncState = None
+    bqnSync.newSyncState = {}
+    bqnSync.syncShard = None
+    bqnSync.bqnPending = 0
+    bqnSync.journal = None
+    bqnSync.journalSeq = 0
+    bqnSync.journalLock = threading.Lock()
+    bqnSync.bqnName = bqnIp
+    return bqnSync
+
+  def getBqnStateFile(self, stateFile, bqnIp):
+    # With several BQNs, each has its own state file
+    return "%s.%s" % (stateFile, bqnIp.replace(":", "_")) if stateFile else None
+
+  def prepareBqnData(self, data, kinds=None):
+    # Adapt data to BQN format (BqnRecord entries were normalized when built),
+    # of some entities if kinds given
+    kinds = kinds or list(BillingSync.SYNC_KINDS)
+    for kind in kinds:
+      for item in data[kind]:
+        if not isinstance(item, BqnRecord):
+          self.normalize(item)
     # Blocked subscribers have block policy
-    for s in data["subscribers"]:
-      if s["block"]:
-        s["policyRate"] = BillingSync.BLOCK_POLICY
-      # Remove block/state fields, unknown to BQN and no longer needed
-      del s["block"]        
-      del s["state"]        
-
-    self.logger.warning("%s synchronization with BQN starts" % datetime.datetime.now())  
-    self.updateBqnPolicies(uriRoot, session, data)
-    self.updateBqnSubscribers(uriRoot, session, data)
-    self.updateBqnSubscriberGroups(uriRoot, session, data)
+    if "subscribers" in kinds:
+      for s in data["subscribers"]:
+        if s["block"]:
+          s["policyRate"] = BillingSync.BLOCK_POLICY
+        # Remove block/state fields, unknown to BQN and no longer needed
+        del s["block"]        
+        del s["state"]        
+    if "subscriberGroups" in kinds:
+      for sg in data["subscriberGroups"]:
+        self.compactSubscriberGroup(sg)
+
+  def prefetchBqnEntries(self, bqns, kinds=None):
+    """
+    Starts reading in background the entries of several BQNs, given as a list
+    of (bqnIp, bqnUser, bqnPassword), so they are read while billing data is
+    obtained. Their next update takes them instead of reading BQN. Only for
+    updates reading BQN in full (without state snapshot). kinds restricts
+    the entities read, all if None.
+    """
+    self.bqnPrefetch.clear()
+    for bqnIp, bqnUser, bqnPassword in bqns:
+      uriRoot = self.getBqnUriRoot(bqnIp)
+      reads = {}
+      for kind in BillingSync.SYNC_KINDS:
+        if kinds is None or kind in kinds:
+          reads[kind] = futures.Future()
+          self.bqnPrefetch[(uriRoot, kind)] = reads[kind]
+      bqnSync = self.getBqnSync(bqnIp) if len(bqns) > 1 else self
+      threading.Thread(target=bqnSync.readBqnEntries, args=(uriRoot, bqnUser, bqnPassword, reads), daemon=True).start()
+
+  def readBqnEntries(self, uriRoot, bqnUser, bqnPassword, reads):
+    # Sets the result of the futures in reads (by entity) with BQN entries
+    try:
+      session = self.getBqnSession(uriRoot, bqnUser, bqnPassword)
+    except Exception as e:
+      session = None
+      error = e
+    for kind, read in reads.items():
+      if session is None:
+        read.set_exception(error)
+        continue
+      try:
+        read.set_result(self.readBqnCollection(uriRoot, session, BillingSync.SYNC_KINDS[kind]["path"].rstrip('/'), kind))
+      except Exception as e:
+        read.set_exception(e)
+
+  def runOnBqns(self, bqns, stateFile, method, data, *args):
+    """
+    Runs a BQN update method on several BQNs, given as a list of (bqnIp,
+    bqnUser, bqnPassword). BQNs are updated concurrently and independently,
+    each with its own session, state file (stateFile with the BQN address as
+    suffix) and result. Returns a dictionary with the result of each BQN by address.
+    """
+    if len(bqns) == 1:
+      bqnIp, bqnUser, bqnPassword = bqns[0]
+      return {bqnIp: self.runBqnUpdate(method, bqnIp, bqnUser, bqnPassword, data, stateFile, *args)}
+
+    if self.metrics.profiler:
+      # One after another, so the phases of each BQN are profiled
+      results = {}
+      for bqnIp, bqnUser, bqnPassword in bqns:
+        bqnSync = self.getBqnSync(bqnIp)
+        try:
+          results[bqnIp] = bqnSync.runBqnUpdate(method, bqnIp, bqnUser, bqnPassword, data,
+                                                self.getBqnStateFile(stateFile, bqnIp), *args)
+        except Exception as e:
+          self.logger.error("%s BQN %s synchronization failed. Exception %s" % (datetime.datetime.now(), bqnIp, e))
+          results[bqnIp] = False
+      return results
+
+    results = {}
+    with futures.ThreadPoolExecutor(max_workers=len(bqns)) as executor:
+      tasks = {}
+      for bqnIp, bqnUser, bqnPassword in bqns:
+        bqnSync = self.getBqnSync(bqnIp)
+        tasks[bqnIp] = executor.submit(bqnSync.runBqnUpdate, method, bqnIp, bqnUser, bqnPassword, data,
+                                       self.getBqnStateFile(stateFile, bqnIp), *args)
+      for bqnIp in tasks:
+        try:
+          results[bqnIp] = tasks[bqnIp].result()
+        except Exception as e:
+          self.logger.error("%s BQN %s synchronization failed. Exception %s" % (datetime.datetime.now(), bqnIp, e))
+          results[bqnIp] = False
+    return results
+
+  def runBqnUpdate(self, method, *args):
+    # The update of each BQN is a phase of its own in metrics. It is not
+    # profiled as a whole, its reads, plans and applies are.
+    phase = self.getPhase(method)
+    self.metrics.start(phase)
+    try:
+      return getattr(self, method)(*args)
+    finally:
+      self.metrics.stop(phase)
+
+  def updateBqns(self, bqns, data, stateFile=None, fullSyncHours=24, kinds=None, dryRun=False, shards=1):
+    """
+    Updates several BQNs with the same billing data (see runOnBqns and
+    updateBqnNode). Returns a dictionary with the result of each BQN by address.
+    data may be a BillingFeed, with entities already adapted.
+    """
+    if not isinstance(data, BillingFeed):
+      self.prepareBqnData(data)
+    return self.runOnBqns(bqns, stateFile, "updateBqnNode", data, fullSyncHours, kinds, dryRun, shards)
+
+  def updateBqnsEntries(self, bqns, data, stateFile=None):
+    """
+    Sends the subscribers in billing data and their policies to several BQNs
+    (see runOnBqns and updateBqnNodeEntries), leaving other BQN entries as
+    they are. Returns a dictionary with the result of each BQN by address.
+    """
+    self.prepareBqnData(data)
+    return self.runOnBqns(bqns, stateFile, "updateBqnNodeEntries", data)
+
+  def updateBqnNodeEntries(self, bqnIp, bqnUser, bqnPassword, data, stateFile=None):
+    """
+    Creates or updates in BQN the subscribers in billing data and the policies
+    they use, comparing them with their entries in BQN, read one by one. No BQN
+    entry is deleted, and subscribers whose BQN entry has another subscriber
+    id are skipped (a duplicated IP). Used to apply the changes of some
+    clients at once, without reading all BQN entries. The state snapshot, if
+    any, is updated with the changes, so the next update does not send them
+    again.
+    Returns True if all BQN updates succeeded.
+    """
+    uriRoot = self.getBqnUriRoot(bqnIp)
+    session = self.getBqnSession(uriRoot, bqnUser, bqnPassword)
+
+    self.bqnErrors = []
+    used = set(s["policyRate"] for s in data["subscribers"])
+    entries = {
+      "policies": [p for p in data["policies"] if p["policyName"] in used],
+      "subscribers": data["subscribers"]
+    }
+    if BillingSync.BLOCK_POLICY in used:
+      entries["policies"].append(dict(self.getBlockPolicy(), policyName=BillingSync.BLOCK_POLICY))
+
+    changes = {}
+    # Policies before the subscribers using them
+    for kind in entries:
+      spec = BillingSync.SYNC_KINDS[kind]
+      changes[kind] = []
+      for e in entries[kind]:
+        key = e[spec["key"]]
+        rsp = self.bqnApiRequest(session, 'get', uriRoot + spec["path"], key)
+        if rsp is None or rsp.status_code not in [200, 404]:
+          self.bqnErrors.append("get %s" % (uriRoot + spec["path"] + key))
+          continue
+        current = rsp.json() if rsp.status_code == 200 else None
+        if current is None:
+          method = 'post'
+          entry = dict(e)
+          if kind == "subscribers":
+            entry["policyAssignedBy"] = BillingSync.STATE_ASSIGNED_BY
+        elif kind == "subscribers" and current.get("subscriberId") not in [None, "", e["subscriberId"]]:
+          self.logger.warning("%s %sDuplicated IP %s ignored (assigned to two different customers, %s and %s)" % \
+            (datetime.datetime.now(), self.getBqnLabel(), key, current.get("subscriberId"), e["subscriberId"]))
+          continue
+        else:
+          fields = self.getSyncFields(kind, current, e)
+          if self.getFingerprint(current, fields, spec["excluded"]) == self.getFingerprint(e, fields, spec["excluded"]):
+            continue
+          method = 'put'
+          entry = dict(current)
+          entry.update(e)
+        self.logger.debug("%s %s %s" % (method.capitalize(), spec["name"], key))
+        rsp = self.bqnApiWrite(None, session, method, uriRoot + spec["path"], key, e)
+        if rsp is not None and rsp.status_code < 300:
+          changes[kind].append(entry)
+
+    self.logger.warning("%s %s%d policies and %d subscribers updated" % \
+                        (datetime.datetime.now(), self.getBqnLabel(), len(changes["policies"]), len(changes["subscribers"])))
+    if stateFile:
+      self.mergeSyncState(stateFile, uriRoot, changes)
+
+    return len(self.bqnErrors) == 0
+
+  def mergeSyncState(self, stateFile, uriRoot, changes):
+    """
+    Updates the entries of the state snapshot with those changed in BQN
+    outside an update, given by entity. The snapshot keeps its save time, so
+    a pending journal still applies to it.
+    """
+    try:
+      with open(stateFile, encoding="utf-8") as f:
+        state = json.load(f)
+    except (OSError, ValueError):
+      return
+    if state.get("bqn") != uriRoot:
+      return
+    for kind in changes:
+      if not kind in state:
+        continue
+      keyField = BillingSync.SYNC_KINDS[kind]["key"]
+      entries = {e[keyField]: e for e in state[kind]}
+      for e in changes[kind]:
+        entries[e[keyField]] = e
+      state[kind] = list(entries.values())
+    self.syncState = state
+    self.newSyncState = {}
+    self.saveSyncState(stateFile, uriRoot, state.get("lastFullSync", 0), state.get("saved"))
+
+  def updateBqn(self, bqnIp, bqnUser, bqnPassword, data, stateFile=None, fullSyncHours=24, kinds=None, dryRun=False, shards=1):
+    """
+    Updates one BQN with billing data. See updateBqnNode.
+    """
+    self.prepareBqnData(data)
+    return self.runBqnUpdate("updateBqnNode", bqnIp, bqnUser, bqnPassword, data, stateFile, fullSyncHours, kinds, dryRun, shards)
+
+  def updateBqnNode(self, bqnIp, bqnUser, bqnPassword, data, stateFile=None, fullSyncHours=24, kinds=None, dryRun=False, shards=1):
+    """
+    Updates BQN with billing data, already adapted with prepareBqnData. If
+    stateFile is given, the BQN contents left by a successful update are saved
+    there and the next update sends the differences with it, without reading
+    BQN. BQN is read in full at least every fullSyncHours to correct any drift.
+    kinds restricts the update to some entities ("policies", "subscribers",
+    "subscriberGroups"), those that may have changed. All if None.
+    If dryRun, the planned operations are logged and BQN is not updated.
+    data may be a BillingFeed, so each entity is updated once it is available.
+    With shards greater than 1, subscribers are split in that number of groups
+    by IP hash, and only the changes of one group are sent, the next with
+    changes in rotation (saved in the snapshot). Policies and subscriber groups
+    are always updated in full, so no subscriber refers to a missing policy,
+    and subscriber groups without the subscribers whose creation was left to
+    later updates. Policies are deleted after subscribers and groups are
+    updated, and only if none of them uses the policy any more.
+    Once the deadline (if set) is past, no more changes are sent and those
+    left are reported and kept for the next update. Policies are not deleted
+    while subscribers left undone may still use them.
+    Returns True if all BQN updates succeeded and none was left to later updates.
+    """
+
+    uriRoot = self.getBqnUriRoot(bqnIp)
+    session = self.getBqnSession(uriRoot, bqnUser, bqnPassword)
+
+    self.logger.warning("%s %ssynchronization with BQN starts" % (datetime.datetime.now(), self.getBqnLabel()))
+    # Each phase waits for its writes, so policies exist before the subscribers
+    # using them and subscribers before the groups they belong to
+    self.bqnErrors = []
+    self.newSyncState = {}
+    self.syncState = None
+    self.syncShard = None
+    self.bqnPending = 0
+    if stateFile:
+      # The journal of the writes of an update is removed when it succeeds.
+      # If present, the last update did not finish and is resumed.
+      journalFile = stateFile + ".journal"
+      self.syncState = self.loadSyncState(stateFile, uriRoot, fullSyncHours)
+      if self.syncState and os.path.exists(journalFile):
+        self.resumeJournal(journalFile, uriRoot)
+        if not dryRun:
+          self.saveSyncState(stateFile, uriRoot, self.syncState["lastFullSync"])
+          self.syncState = self.loadSyncState(stateFile, uriRoot, fullSyncHours)
+      if not dryRun:
+        self.openJournal(journalFile, uriRoot)
+    self.bqnWriter = BqnWriteExecutor(self.logger, BillingSync.BQN_MAX_REQUESTS, BillingSync.BQN_TARGET_LATENCY)
+    skipped = []
+    notCreated = set()  # Subscribers left out of groups
+    plans = {}
+    policyDeletions = []  # Sent once subscribers are updated
+    try:
+      for kind in BillingSync.SYNC_KINDS:
+        if kinds is not None and kind not in kinds:
+          continue
+        if not dryRun and self.isPastDeadline():
+          skipped.append(kind)
+          continue
+        if isinstance(data, BillingFeed):
+          kindData = {kind: data.get(kind)}  # Waits until available
+          if kindData[kind] is None:
+            continue
+        else:
+          kindData = data
+        if kind == "subscriberGroups" and notCreated and kindData.get(kind):
+          kindData = {kind: self.restrictGroupMembers(kindData[kind], notCreated)}
+        plan = self.planBqnUpdate(uriRoot, session, kindData, kind)
+        if not plan:
+          continue
+        if kind == "subscribers" and shards > 1:
+          self.restrictBqnShard(plan, shards)
+        if kind == "policies":
+          policyDeletions = self.holdBqnDeletions(plan)
+        if dryRun:
+          self.printPlan(uriRoot, plan)
+        else:
+          self.applyBqnPlan(uriRoot, session, plan)
+        plans[kind] = plan
+        if kind == "subscribers":
+          notCreated = plan.deferred
+      if policyDeletions and not dryRun and self.isPastDeadline():
+        # Subscribers moved out of them may have been left undone as well
+        self.bqnPending += len(policyDeletions)
+        self.logger.warning("%s %sdeadline reached, %d policy deletions left to next synchronization" % \
+                            (datetime.datetime.now(), self.getBqnLabel(), len(policyDeletions)))
+      elif policyDeletions:
+        self.deleteUnusedPolicies(uriRoot, session, plans, policyDeletions, dryRun)
+    finally:
+      self.bqnWriter.shutdown()
+      self.bqnWriter = None
+      self.closeJournal()
+    if skipped:
+      self.logger.warning("%s %sdeadline reached, %s not synchronized, left to next synchronization" % \
+                          (datetime.datetime.now(), self.getBqnLabel(),
+                           ", ".join(BillingSync.SYNC_KINDS[k]["plural"] for k in skipped)))
+
+    if stateFile and not dryRun:
+      if self.bqnErrors:
+        # Snapshot and journal kept, the next update resumes this one
+        self.logger.warning("%s %s%d BQN updates failed, to be retried in the next synchronization" % \
+                            (datetime.datetime.now(), self.getBqnLabel(), len(self.bqnErrors)))
+      else:
+        lastFullSync = self.syncState["lastFullSync"] if self.syncState else time.time()
+        self.saveSyncState(stateFile, uriRoot, lastFullSync)
+        os.remove(journalFile)
+
+    return len(self.bqnErrors) == 0 and self.bqnPending == 0 and not skipped
+
+  def holdBqnDeletions(self, plan):
+    """
+    Removes the deletions from a plan, keeping their entries in the plan
+    state as they are in BQN, and returns them. Used for policies, deleted
+    once subscribers are updated (see deleteUnusedPolicies).
+    """
+    deletions = [o for o in plan.operations if o[0] == 'delete']
+    if deletions:
+      plan.operations = [o for o in plan.operations if o[0] != 'delete']
+      self.deferBqnOperations(plan, deletions)
+    return deletions
+
+  def deleteUnusedPolicies(self, uriRoot, session, plans, deletions, dryRun):
+    """
+    Sends the policy deletions held from the policy plan in plans, except
+    those of policies still used by subscribers or subscriber groups after
+    their update (e.g. subscribers in other shards), so no entry left in BQN
+    refers to a missing policy. Those are deleted by a later update, once not
+    used. Without a subscriber plan, the subscribers are those in BQN.
+    """
+    plan = plans["policies"]
+    if "subscribers" in plans:
+      subscribers = plans["subscribers"].state.values()
+    else:
+      subscribers = self.getBqnEntries(uriRoot, session, BillingSync.SYNC_KINDS["subscribers"]["path"].rstrip('/'), "subscribers")
+    used = set(s.get("policyRate") for s in subscribers)
+    if "subscriberGroups" in plans:
+      used.update(g.get("policyRate") for g in plans["subscriberGroups"].state.values())
+    kept = [key for method, key, entry in deletions if key in used]
+    if kept:
+      self.logger.warning("%s %s%d policies not in billing kept, still used by subscribers in BQN, to be deleted in a next synchronization" % \
+                          (datetime.datetime.now(), self.getBqnLabel(), len(kept)))
+    plan.operations = [o for o in deletions if o[1] not in used]
+    if not plan.operations:
+      return
+    for method, key, entry in plan.operations:
+      plan.state.pop(key, None)
+    if dryRun:
+      self.printPlan(uriRoot, plan)
+    else:
+      self.applyBqnPlan(uriRoot, session, plan)
+
+  def restrictBqnShard(self, plan, shards):
+    # Next shard in rotation, from the snapshot (from the first without it)
+    firstShard = (self.syncState or {}).get("shard", 0) % shards
+    shard, pending = self.restrictBqnPlan(plan, shards, firstShard)
+    self.bqnPending += pending
+    if shard is None:
+      return
+    self.syncShard = (shard + 1) % shards
+    self.logger.warning("%s %ssubscriber shard %d of %d: %d changes sent, %d left to next synchronizations" % \
+                        (datetime.datetime.now(), self.getBqnLabel(), shard + 1, shards,
+                         len(plan.operations), pending))
 
   ################################################################################
 
@@ -59,6 +59,8 @@ Main ()
   fi
 
   rm /bqn/root/cron.5/sync-*-bqn.sh
+  # Stop daemons, they end after the synchronization in progress
+  pkill -TERM -f "sync-.*-bqn --daemon"
   echo "Synchronization with billing removed"
   exit 0
 }
@@ -164,6 +164,7 @@ Main ()
   read -p "UISP server: " UISP_SERVER
   read -p "UISP API KEY: " UISP_KEY
   ONLY_GROUPS=$(askConfirmation "Get only location groups? (n for full synchronization)")
+  DAEMON=$(askConfirmation "Run as a daemon? (n to start the script every 5 minutes)")
 
   echo "We are about to setup a cron script with these parameters:"
   echo "  BQN OAM IP: $BQN_OAM_IP"
@@ -172,6 +173,7 @@ Main ()
   echo "  UISP server: $UISP_SERVER"
   echo "  UISP API KEY: $UISP_KEY"
   echo "  Only location groups: $(echoBoolean $ONLY_GROUPS)"
+  echo "  Daemon: $(echoBoolean $DAEMON)"
 
   confirmation=$(askConfirmation "Do you want to proceed?")
   if [[ $confirmation -eq $FALSE ]]; then
@@ -186,7 +188,12 @@ Main ()
   cronSetup
 
   # Copy script to cron.5
-  echo "cd /root/uisp; ./sync-uisp-bqn -b ${BQN_OAM_IP} ${BQN_REST_USER} ${BQN_REST_PW} ${ONLY_GROUPS_OP} ${UISP_SERVER} ${UISP_KEY} >> /tmp/sync-uisp-bqn.log" > ${cronScript}
+  if [[ $DAEMON -eq $TRUE ]]; then
+    # Cron only starts the daemon if not running (e.g. after a reboot)
+    echo "cd /root/uisp; pgrep -f \"sync-uisp-bqn --daemon\" >/dev/null || nohup ./sync-uisp-bqn --daemon -b ${BQN_OAM_IP} ${BQN_REST_USER} ${BQN_REST_PW} ${ONLY_GROUPS_OP} ${UISP_SERVER} ${UISP_KEY} >> /tmp/sync-uisp-bqn.log 2>&1 &" > ${cronScript}
+  else
+    echo "cd /root/uisp; ./sync-uisp-bqn --lock-file /tmp/sync-uisp-bqn.lock -b ${BQN_OAM_IP} ${BQN_REST_USER} ${BQN_REST_PW} ${ONLY_GROUPS_OP} ${UISP_SERVER} ${UISP_KEY} >> /tmp/sync-uisp-bqn.log" > ${cronScript}
+  fi
   chmod a+x  ${cronScript}
 
   echo "Activated billing synchronization"